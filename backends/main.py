@@ -5,6 +5,10 @@ from enum import Enum
 from . import type_defs as td
 from .builtin_nodes import levenshtein_distance, nodes
 
+# Shared, immutable node instances used when creating inputs.
+_VALUE_NODE = td.NodeInstance("ShaderNodeValue", [], [0], [])
+_COMBINE_XYZ = td.NodeInstance("ShaderNodeCombineXYZ", [0, 1, 2], [0], [])
+
 
 class NodeTreeType(Enum):
     """节点树类型枚举"""
@@ -183,12 +187,7 @@ class BackEnd(metaclass=ABCMeta):
         input_vector: bool = True,
     ):
         if dtype == td.DataType.FLOAT or dtype == td.DataType.UNKNOWN:
-            operations.append(
-                td.Operation(
-                    td.OpType.CALL_BUILTIN,
-                    td.NodeInstance("ShaderNodeValue", [], [0], []),
-                )
-            )
+            operations.append(td.Operation(td.OpType.CALL_BUILTIN, _VALUE_NODE))
             if value:
                 operations.append(td.Operation(td.OpType.SET_OUTPUT, (0, value)))
         elif dtype == td.DataType.BOOL:
@@ -244,17 +243,10 @@ class BackEnd(metaclass=ABCMeta):
             else:
                 if value is not None:
                     assert isinstance(value, list), "Vec3 should be list of floats"
-                    for v in value:
-                        operations.append(td.Operation(td.OpType.PUSH_VALUE, v))
                 else:
-                    for _ in range(3):
-                        operations.append(td.Operation(td.OpType.PUSH_VALUE, None))
-                operations.append(
-                    td.Operation(
-                        td.OpType.CALL_BUILTIN,
-                        td.NodeInstance("ShaderNodeCombineXYZ", [0, 1, 2], [0], []),
-                    )
-                )
+                    value = [None, None, None]
+                operations.extend(td.Operation(td.OpType.PUSH_VALUE, v) for v in value)
+                operations.append(td.Operation(td.OpType.CALL_BUILTIN, _COMBINE_XYZ))
         elif dtype == td.DataType.STRING:
             operations.append(
                 td.Operation(
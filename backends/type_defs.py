@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from enum import IntEnum, auto
-from typing import Union
+from typing import Any, NamedTuple, Union
 
 
 class DataType(IntEnum):
@@ -95,17 +95,19 @@ class OpType(IntEnum):
     # Get the variable with the given name, and push it onto the stack.
     GET_VAR = auto()
     # Replace the last item on the stack with the element at the given index.
-    # The indexing is reversed.
     # If stack looked like [x,y,[z,w]] then after GET_OUTPUT 1 it looks like
-    # [x,y,z]
+    # [x,y,w]
     GET_OUTPUT = auto()
     # Set the ouput of the last added node to the given value. Data is a
     # tuple of the output index and the value to be set.
     SET_OUTPUT = auto()
     # Set the functions output at the given index to the value on top of the stack.
     SET_FUNCTION_OUT = auto()
-    # Split the last item on the stack into individual items. So if the
-    # stack looked like [x,y,[z,w,v]] it would become [x,y,z,w,v].
+    # Push the items of the last item on the stack at the given output
+    # indices, in the order of the list. So if the stack looked like
+    # [x,y,[z,w,v]] then after SPLIT_STRUCT [2, 0] it looks like [x,y,v,z].
+    # The compiler lists the indices reversed, so that the first one ends up
+    # on top.
     SPLIT_STRUCT = auto()
     # Call the given function, all the arguments are on the stack. The data
     # is a CompiledFunction
@@ -114,14 +116,20 @@ class OpType(IntEnum):
     CALL_NODEGROUP = auto()
     # Create the built-in node. Data is a NodeInstance.
     CALL_BUILTIN = auto()
+    # Same as CALL_BUILTIN, but the arguments are not on the stack. Data is a
+    # tuple of the NodeInstance and a list of (is_var, value) pairs, where the
+    # value is either the name of a variable or the argument itself.
+    CALL_BUILTIN_WITH_ARGS = auto()
     # Set the label of the last added node to the given name.
     RENAME_NODE = auto()
     # Create a node group tree
     CREATE_NODE_GROUP = auto()
     # Create a repeat zone
     CREATE_REPEAT_ZONE = auto()
-    # Repeat body operations
+    # Repeat body operations. Data is a CompiledRepeat.
     REPEAT_BODY = auto()
+    # Execute the body of a loop once for every index. Data is a CompiledLoop.
+    LOOP = auto()
     # Create a reroute node
     CREATE_VAR = auto()
     # End of statement
@@ -136,7 +144,7 @@ class BuiltinNode:
     outputs: list[tuple[str, DataType]]
 
 
-@dataclass
+@dataclass(frozen=True)
 class NodeInstance:
     # Key in the nodes dict
     key: str
@@ -148,10 +156,9 @@ class NodeInstance:
     props: list[tuple[str, ValueType]]
 
 
-class Operation:
-    def __init__(self, op_type: OpType, data) -> None:
-        self.op_type = op_type
-        self.data = data
+class Operation(NamedTuple):
+    op_type: OpType
+    data: Any
 
     def __str__(self) -> str:
         return f"({self.op_type.name}, {self.data})"
@@ -273,16 +280,33 @@ class TyRepeat(ty_stmt):
     body: list[ty_stmt]
 
 
-@dataclass
+@dataclass(slots=True)
 class CompiledFunction:
     inputs: list[str]
     body: list[Operation]
     num_outputs: int
 
 
-@dataclass
+@dataclass(slots=True)
 class CompiledNodeGroup:
     name: str
     inputs: list[TyArg]
     outputs: list[TyArg]
     body: list[Operation]
+
+
+@dataclass(slots=True)
+class CompiledLoop:
+    # Name of the loop variable, which is bound to the index of each iteration.
+    var: Union[str, None]
+    start: int
+    end: int
+    body: list[Operation]
+
+
+@dataclass(slots=True)
+class CompiledRepeat:
+    body: list[Operation]
+    # Names of the variables that are assigned in the body, including in nested
+    # loops and repeat zones, in the order they are first assigned.
+    loop_vars: list[str]
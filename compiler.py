@@ -5,6 +5,70 @@ from .backends.shader_nodes import ShaderNodesBackEnd
 from .mf_parser import Error
 from .type_checking import TypeChecker
 
+# Enum members that are compared against for every statement or argument.
+# Looking up a member on its enum class is much slower than reading a global.
+_STRUCT = td.StackType.STRUCT
+_VEC3 = td.DataType.VEC3
+_RGBA = td.DataType.RGBA
+
+# Node instances are immutable, so the ones that the compiler emits itself can
+# be shared between all operations instead of being rebuilt every time.
+_SEPARATE_XYZ = td.NodeInstance("ShaderNodeSeparateXYZ", [0], [0, 1, 2], [])
+
+# Operations are never modified once emitted, so the most common ones are
+# shared as well.
+_END_OF_STATEMENT = td.Operation(td.OpType.END_OF_STATEMENT, None)
+_PUSH_DEFAULT = td.Operation(td.OpType.PUSH_VALUE, None)
+_CALL_SEPARATE_XYZ = td.Operation(td.OpType.CALL_BUILTIN, _SEPARATE_XYZ)
+_GET_OUTPUT = [td.Operation(td.OpType.GET_OUTPUT, i) for i in range(8)]
+
+_PUSH_VALUE = td.OpType.PUSH_VALUE
+_GET_VAR = td.OpType.GET_VAR
+_CALL_BUILTIN = td.OpType.CALL_BUILTIN
+_BIND_VAR = td.OpType.BIND_VAR
+_REPEAT_BODY = td.OpType.REPEAT_BODY
+
+
+def _get_output_op(index: int) -> td.Operation:
+    if index < len(_GET_OUTPUT):
+        return _GET_OUTPUT[index]
+    return td.Operation(td.OpType.GET_OUTPUT, index)
+
+
+def _collect_bound_vars(operations: list[td.Operation], names: dict[str, None]):
+    # A dict is used as an ordered set. Loops are not allowed inside a repeat
+    # zone, so only nested repeat zones have to be looked into.
+    for op_type, data in operations:
+        if op_type == _BIND_VAR:
+            names[data] = None
+        elif op_type == _REPEAT_BODY:
+            names.update(dict.fromkeys(data.loop_vars))
+
+
+def _fuse_operations(operations: list[td.Operation]) -> list[td.Operation]:
+    """
+    Replace every CALL_BUILTIN whose arguments are all pushed by the
+    operations right before it with a single CALL_BUILTIN_WITH_ARGS.
+    """
+    fused: list[td.Operation] = []
+    for operation in operations:
+        if operation.op_type == _CALL_BUILTIN and (
+            num_args := len(operation.data.inputs)
+        ) <= len(fused):
+            # Every PUSH_VALUE and GET_VAR pushes exactly one item, so if the
+            # last operations are all of those they pushed the arguments.
+            pushes = fused[len(fused) - num_args :]
+            if num_args > 0 and all(
+                op.op_type == _PUSH_VALUE or op.op_type == _GET_VAR for op in pushes
+            ):
+                del fused[len(fused) - num_args :]
+                arg_sources = [(op.op_type == _GET_VAR, op.data) for op in pushes]
+                operation = td.Operation(
+                    td.OpType.CALL_BUILTIN_WITH_ARGS, (operation.data, arg_sources)
+                )
+        fused.append(operation)
+    return fused
+
 
 class Compiler:
     @staticmethod
@@ -30,14 +94,45 @@ class Compiler:
         else:
             self.type_checker = TypeChecker(self.back_end, {})
         self.curr_function: td.TyFunction | None = None
+        # The last source that was type checked and whether that succeeded.
+        self._last_checked: tuple[str, bool] | None = None
+        # Prebuilt operations for calling a function, keyed by the identity of
+        # its TyFunction: one push per default argument, and the call itself
+        # with the compiled body, so that every call reuses them.
+        self._call_cache: dict[int, tuple[list[td.Operation], td.Operation]] = {}
+        # Map from the typed AST class to the method compiling it.
+        self._expr_dispatch = {
+            td.Const: self.const,
+            td.Var: self.var,
+            td.NodeCall: self.node_call,
+            td.GetOutput: self.get_output,
+            td.FunctionCall: self.func_call,
+        }
+        # Expressions can also be used as statements.
+        self._stmt_dispatch = {
+            **self._expr_dispatch,
+            td.TyAssign: self.compile_assign_like,
+            td.TyOut: self.compile_assign_like,
+            td.TyLoop: self.compile_loop,
+            td.TyRepeat: self.compile_repeat,
+        }
+
+    def type_check(self, source: str) -> bool:
+        # Type checking the same source again would only redo the work, and
+        # add its statements and functions a second time.
+        if self._last_checked is not None and self._last_checked[0] == source:
+            return self._last_checked[1]
+        succeeded = self.type_checker.type_check(source)
+        self._last_checked = (source, succeeded)
+        return succeeded
 
     def check_functions(self, source: str) -> bool:
-        self.type_checker.type_check(source)
+        self.type_check(source)
         self.errors = self.type_checker.errors
         return self.errors == []
 
     def compile(self, source: str) -> bool:
-        succeeded = self.type_checker.type_check(source)
+        succeeded = self.type_check(source)
         typed_ast = self.type_checker.typed_repr
         self.errors = self.type_checker.errors
         if not succeeded:
@@ -45,53 +140,55 @@ class Compiler:
         statements = typed_ast.body
         for statement in statements:
             self.compile_statement(statement)
+        self.operations = _fuse_operations(self.operations)
         return True
 
     def compile_statement(self, stmt: td.ty_stmt):
-        if isinstance(stmt, td.ty_expr):
-            self.compile_expr(stmt)
-        elif isinstance(stmt, td.TyAssign):
-            self.compile_assign_like(stmt)
-        elif isinstance(stmt, td.TyOut):
-            self.compile_assign_like(stmt)
-        elif isinstance(stmt, td.TyLoop):
-            self.compile_loop(stmt)
-        elif isinstance(stmt, td.TyRepeat):
-            self.compile_repeat(stmt)
-        else:
-            # These are the only possibilities for now
-            assert False, "Unreachable code"
-        self.operations.append(td.Operation(td.OpType.END_OF_STATEMENT, None))
+        compile_stmt = self._stmt_dispatch.get(type(stmt))
+        # These are the only possibilities for now
+        assert compile_stmt is not None, "Unreachable code"
+        compile_stmt(stmt)
+        self.operations.append(_END_OF_STATEMENT)
 
     def compile_loop(self, loop: td.TyLoop):
         outer_ops = self.operations
         self.operations = []
         for stmt in loop.body:
             self.compile_statement(stmt)
-        compiled_body = self.operations
+        compiled_body = _fuse_operations(self.operations)
         self.operations = outer_ops
 
-        # TODO: Let the interpreter do the looping
-        for i in range(loop.start, loop.end + 1):
-            if loop.var is not None:
-                self.operations.append(td.Operation(td.OpType.PUSH_VALUE, i))
-                self.operations.append(td.Operation(td.OpType.BIND_VAR, loop.var.id))
-            self.operations += compiled_body
+        # The body is compiled only once, the interpreter does the looping.
+        var = loop.var.id if loop.var is not None else None
+        self.operations.append(
+            td.Operation(
+                td.OpType.LOOP,
+                td.CompiledLoop(var, loop.start, loop.end, compiled_body),
+            )
+        )
 
     def compile_repeat(self, repeat: td.TyRepeat):
         outer_ops = self.operations
         self.operations = []
         for stmt in repeat.body:
             self.compile_statement(stmt)
-        compiled_body = self.operations
+        compiled_body = _fuse_operations(self.operations)
         self.operations = outer_ops
+        # The variables that may have to be passed through the repeat zone.
+        loop_vars: dict[str, None] = {}
+        _collect_bound_vars(compiled_body, loop_vars)
+        compiled_repeat = td.CompiledRepeat(compiled_body, list(loop_vars))
 
         # Compile iterations expression first
         self.compile_expr(repeat.iterations)
         
         # Create repeat zone operations with iterations from stack
-        self.operations.append(td.Operation(td.OpType.CREATE_REPEAT_ZONE, None))
-        self.operations.append(td.Operation(td.OpType.REPEAT_BODY, compiled_body))
+        self.operations.extend(
+            (
+                td.Operation(td.OpType.CREATE_REPEAT_ZONE, None),
+                td.Operation(td.OpType.REPEAT_BODY, compiled_repeat),
+            )
+        )
 
     def compile_assign_like(self, assign: td.TyAssign | td.TyOut):
         targets = assign.targets
@@ -124,22 +221,27 @@ class Compiler:
         self.compile_expr(assign.value)
         
         if len(targets) > 1:
-            if assign.value.stype == td.StackType.STRUCT:
-                self.operations.append(td.Operation(td.OpType.SPLIT_STRUCT, None))
-            elif assign.value.dtype[0] == td.DataType.VEC3:
-                self.operations.append(
-                    td.Operation(
-                        td.OpType.CALL_BUILTIN,
-                        td.NodeInstance("ShaderNodeSeparateXYZ", [0], [0, 1, 2], []),
-                    )
-                )
-                self.operations.append(td.Operation(td.OpType.SPLIT_STRUCT, None))
-            elif assign.value.dtype[0] == td.DataType.RGBA:
+            if assign.value.stype == _STRUCT:
+                # The outputs are already on the stack as a struct.
+                pass
+            elif assign.value.dtype[0] == _VEC3:
+                self.operations.append(_CALL_SEPARATE_XYZ)
+            elif assign.value.dtype[0] == _RGBA:
                 raise NotImplementedError
             else:
                 assert False, "Unreachable, bug in type checker"
-        elif isinstance(assign, td.TyOut) and assign.value.stype == td.StackType.STRUCT:
-            self.operations.append(td.Operation(td.OpType.GET_OUTPUT, 0))
+            # Only extract the outputs that are actually assigned.
+            used = [i for i, target in enumerate(targets) if target is not None]
+            if len(used) == 1:
+                self.operations.append(_get_output_op(used[0]))
+            elif used != []:
+                # Reversed, so that the first output ends up on top of the
+                # stack and the targets are bound in order.
+                self.operations.append(
+                    td.Operation(td.OpType.SPLIT_STRUCT, used[::-1])
+                )
+        elif isinstance(assign, td.TyOut) and assign.value.stype == _STRUCT:
+            self.operations.append(_GET_OUTPUT[0])
         
         for target in targets:
             if target is None:
@@ -151,73 +253,69 @@ class Compiler:
                 self.operations.append(td.Operation(td.OpType.SET_FUNCTION_OUT, target))
 
     def compile_expr(self, expr: td.ty_expr):
-        if isinstance(expr, td.Const):
-            self.const(expr)
-        elif isinstance(expr, td.Var):
-            self.var(expr)
-        elif isinstance(expr, td.NodeCall):
-            self.node_call(expr)
-        elif isinstance(expr, td.GetOutput):
-            self.get_output(expr)
-        elif isinstance(expr, td.FunctionCall):
-            self.func_call(expr)
-        else:
+        compile_expr = self._expr_dispatch.get(type(expr))
+        if compile_expr is None:
             print(expr, type(expr))
             assert False, "Unreachable code"
+        compile_expr(expr)
 
-    def compile_function(self, func: td.TyFunction) -> td.CompiledFunction:
+    def compile_body(self, func: td.TyFunction) -> list[td.Operation]:
         outer_ops = self.operations
+        outer_function = self.curr_function
         self.operations = []
         self.curr_function = func
         for stmt in func.body:
             self.compile_statement(stmt)
-        compiled_body = self.operations
+        compiled_body = _fuse_operations(self.operations)
         self.operations = outer_ops
+        self.curr_function = outer_function
+        return compiled_body
+
+    def compile_function(self, func: td.TyFunction) -> td.CompiledFunction:
         return td.CompiledFunction(
-            [i.name for i in func.inputs], compiled_body, len(func.outputs)
+            [i.name for i in func.inputs], self.compile_body(func), len(func.outputs)
         )
 
     def compile_node_group(self, func: td.TyFunction) -> td.CompiledNodeGroup:
-        outer_ops = self.operations
-        self.operations = []
-        self.curr_function = func
-        for stmt in func.body:
-            self.compile_statement(stmt)
-        compiled_body = self.operations
-        self.operations = outer_ops
-        return td.CompiledNodeGroup(func.name, func.inputs, func.outputs, compiled_body)
+        return td.CompiledNodeGroup(
+            func.name, func.inputs, func.outputs, self.compile_body(func)
+        )
 
-    def func_call(self, expr: td.FunctionCall):
-        for arg in expr.args:
+    def _emit_args(self, args: list[td.ty_expr]):
+        # Compiling an argument may swap self.operations, but always restores
+        # the same list afterwards.
+        operations = self.operations
+        for arg in args:
             self.compile_expr(arg)
-            if arg.stype == td.StackType.STRUCT:
+            if arg.stype == _STRUCT:
                 # Get the output we need.
-                self.operations.append(td.Operation(td.OpType.GET_OUTPUT, 0))
+                operations.append(_GET_OUTPUT[0])
+
+    def func_call(self, expr: td.FunctionCall):
+        self._emit_args(expr.args)
+        defaults, call = self._call_ops(expr.function)
         # Add the implicit default arguments here
-        for i in range(len(expr.args), len(expr.function.inputs)):
-            self.operations.append(
-                td.Operation(td.OpType.PUSH_VALUE, expr.function.inputs[i].value)
-            )
-        if expr.function.is_node_group:
-            self.operations.append(
-                td.Operation(
-                    td.OpType.CALL_NODEGROUP, self.compile_node_group(expr.function)
-                )
-            )
-            return
-        self.operations.append(
-            td.Operation(td.OpType.CALL_FUNCTION, self.compile_function(expr.function))
-        )
+        self.operations.extend(defaults[len(expr.args) :])
+        self.operations.append(call)
+
+    def _call_ops(self, func: td.TyFunction) -> tuple[list[td.Operation], td.Operation]:
+        key = id(func)
+        if key in self._call_cache:
+            return self._call_cache[key]
+        defaults = [td.Operation(td.OpType.PUSH_VALUE, i.value) for i in func.inputs]
+        if func.is_node_group:
+            call = td.Operation(td.OpType.CALL_NODEGROUP, self.compile_node_group(func))
+        else:
+            call = td.Operation(td.OpType.CALL_FUNCTION, self.compile_function(func))
+        self._call_cache[key] = (defaults, call)
+        return defaults, call
 
     def node_call(self, expr: td.NodeCall):
-        for arg in expr.args:
-            self.compile_expr(arg)
-            if arg.stype == td.StackType.STRUCT:
-                # Get the output we need.
-                self.operations.append(td.Operation(td.OpType.GET_OUTPUT, 0))
+        self._emit_args(expr.args)
         # Add the implicit default arguments here
-        for _ in range(len(expr.node.inputs) - len(expr.args)):
-            self.operations.append(td.Operation(td.OpType.PUSH_VALUE, None))
+        self.operations.extend(
+            _PUSH_DEFAULT for _ in range(len(expr.node.inputs) - len(expr.args))
+        )
         self.operations.append(td.Operation(td.OpType.CALL_BUILTIN, expr.node))
 
     def const(self, const: td.Const):
@@ -232,4 +330,4 @@ class Compiler:
 
     def get_output(self, get_output: td.GetOutput):
         self.compile_expr(get_output.value)
-        self.operations.append(td.Operation(td.OpType.GET_OUTPUT, get_output.index))
+        self.operations.append(_get_output_op(get_output.index))
@@ -1,11 +1,13 @@
-from typing import cast
+from typing import Any, Callable, cast
 
 import bpy
 from bpy.types import Node, NodeSocket
 
 from .backends.type_defs import (
     CompiledFunction,
+    CompiledLoop,
     CompiledNodeGroup,
+    CompiledRepeat,
     DataType,
     NodeInstance,
     Operation,
@@ -13,6 +15,51 @@ from .backends.type_defs import (
     ValueType,
 )
 
+# Check the operation data while running. The type checker and compiler
+# already guarantee it, so this is only useful when debugging those.
+_VALIDATE = False
+
+# Socket type of the node group interface sockets for every data type.
+_DTYPE_TO_SOCKET: dict[DataType, str] = {
+    DataType.BOOL: "NodeSocketBool",
+    DataType.INT: "NodeSocketInt",
+    DataType.FLOAT: "NodeSocketFloat",
+    DataType.RGBA: "NodeSocketColor",
+    DataType.VEC3: "NodeSocketVector",
+    DataType.GEOMETRY: "NodeSocketGeometry",
+    DataType.STRING: "NodeSocketString",
+    DataType.SHADER: "NodeSocketShader",
+    DataType.OBJECT: "NodeSocketObject",
+    DataType.IMAGE: "NodeSocketImage",
+    DataType.COLLECTION: "NodeSocketCollection",
+    DataType.TEXTURE: "NodeSocketTexture",
+    DataType.MATERIAL: "NodeSocketMaterial",
+    DataType.ROTATION: "NodeSocketRotation",
+}
+# The same mapping indexed by the DataType value, None for the data types that
+# cannot be used as a socket.
+_DTYPE_SOCKETS: tuple[str | None, ...] = tuple(
+    _DTYPE_TO_SOCKET.get(dtype) for dtype in DataType
+)
+
+# Repeat zone item type for every socket bl_idname.
+_SOCKET_TO_REPEAT_TYPE: dict[str, str] = {
+    "NodeSocketBool": "BOOLEAN",
+    "NodeSocketInt": "INT",
+    "NodeSocketFloat": "FLOAT",
+    "NodeSocketColor": "RGBA",
+    "NodeSocketVector": "VECTOR",
+    "NodeSocketGeometry": "GEOMETRY",
+    "NodeSocketString": "STRING",
+    "NodeSocketShader": "SHADER",
+    "NodeSocketObject": "OBJECT",
+    "NodeSocketImage": "IMAGE",
+    "NodeSocketCollection": "COLLECTION",
+    "NodeSocketTexture": "TEXTURE",
+    "NodeSocketMaterial": "MATERIAL",
+    "NodeSocketRotation": "ROTATION",
+}
+
 
 class Interpreter:
     def __init__(self, tree: bpy.types.NodeTree) -> None:
@@ -28,145 +75,222 @@ class Interpreter:
         self.function_outputs: list[NodeSocket | None] = []
         # Stack for nested repeat zones to support nesting and function contexts
         self.repeat_zone_stack: list[dict] = []
+        # Node group trees are created with the same type as the tree, so
+        # the type of their group nodes never changes.
+        self._group_node_type = (
+            "GeometryNodeGroup"
+            if tree.bl_idname == "GeometryNodeTree"
+            else "ShaderNodeGroup"
+        )
+        # Handler of every operation type, indexed by the OpType value, so
+        # that dispatching an operation is a single list lookup.
+        handlers = {
+            OpType.PUSH_VALUE: self._op_push_value,
+            OpType.BIND_VAR: self._op_bind_var,
+            OpType.GET_VAR: self._op_get_var,
+            OpType.GET_OUTPUT: self._op_get_output,
+            OpType.SET_OUTPUT: self._op_set_output,
+            OpType.SET_FUNCTION_OUT: self._op_set_function_out,
+            OpType.SPLIT_STRUCT: self._op_split_struct,
+            OpType.CALL_FUNCTION: self._op_call_function,
+            OpType.CALL_NODEGROUP: self._op_call_nodegroup,
+            OpType.CALL_BUILTIN: self._op_call_builtin,
+            OpType.CALL_BUILTIN_WITH_ARGS: self._op_call_builtin_with_args,
+            OpType.RENAME_NODE: self._op_rename_node,
+            OpType.CREATE_NODE_GROUP: self._op_create_node_group,
+            OpType.CREATE_REPEAT_ZONE: self._op_create_repeat_zone,
+            OpType.REPEAT_BODY: self._op_repeat_body,
+            OpType.LOOP: self._op_loop,
+            OpType.CREATE_VAR: self._op_create_var,
+            OpType.END_OF_STATEMENT: self._op_end_of_statement,
+        }
+        assert len(handlers) == len(OpType), "Exhaustive handling of Operation types."
+        self._dispatch: list[Callable[[Any], None]] = [
+            handlers[op_type] for op_type in OpType
+        ]
 
     def operation(self, operation: Operation):
-        op_type = operation.op_type
-        op_data = operation.data
-        assert (
-            OpType.END_OF_STATEMENT.value == 15
-        ), "Exhaustive handling of Operation types."
-        
-        if op_type == OpType.PUSH_VALUE:
-            self.stack.append(op_data)
-        
-        elif op_type == OpType.CREATE_VAR:
+        op_type, op_data = operation
+        self._dispatch[op_type](op_data)
+
+    def execute(self, operations: list[Operation]):
+        """Execute the operations in order, with a single dispatch per operation"""
+        dispatch = self._dispatch
+        for op_type, op_data in operations:
+            dispatch[op_type](op_data)
+
+    def _op_push_value(self, op_data):
+        self.stack.append(op_data)
+
+    def _op_create_var(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, str), "Variable name should be a string."
-            # Create a reroute node for the variable
-            reroute_node = self.tree.nodes.new("NodeReroute")
-            reroute_node.label = op_data
-            self.nodes.append(reroute_node)
-            # Store the reroute node's output socket as the variable
-            self.variables[op_data] = reroute_node.outputs[0]
-
-        elif op_type == OpType.BIND_VAR:
+        # Create a reroute node for the variable
+        reroute_node = self.tree.nodes.new("NodeReroute")
+        reroute_node.label = op_data
+        self.nodes.append(reroute_node)
+        # Store the reroute node's output socket as the variable
+        self.variables[op_data] = reroute_node.outputs[0]
+
+    def _op_bind_var(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, str), "Variable name should be a string."
-            socket = self.stack.pop()
+        socket = self.stack.pop()
+        if _VALIDATE:
             assert isinstance(
                 socket, (NodeSocket, list, int)
             ), "Create var expects a node socket or struct or loop index."
-            if isinstance(socket, list):
-                socket = cast(list[NodeSocket], socket)
-            self.variables[op_data] = socket
-        
-        elif op_type == OpType.GET_VAR:
+        self.variables[op_data] = socket
+
+    def _op_get_var(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, str), "Variable name should be a string."
-            self.stack.append(self.variables[op_data])
-        
-        elif op_type == OpType.GET_OUTPUT:
+        self.stack.append(self.variables[op_data])
+
+    def _op_get_output(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, int), "Bug in type checker, index should be int."
-            index = op_data
-            struct = self.stack.pop()
+        index = op_data
+        stack = self.stack
+        struct = stack[-1]
+        if _VALIDATE:
             assert isinstance(
                 struct, list
             ), "Bug in type checker, GET_OUTPUT only works on structs."
-            # Index order is reversed
-            self.stack.append(struct[-index - 1])
+        # The output replaces the struct on top of the stack, without a pop
+        # and append.
+        stack[-1] = struct[index]
 
-        elif op_type == OpType.SET_OUTPUT:
+    def _op_set_output(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, tuple), "Data should be tuple of index and value"
-            index, value = op_data
-            self.nodes[-1].outputs[index].default_value = value  # type: ignore
-        
-        elif op_type == OpType.SET_FUNCTION_OUT:
+        index, value = op_data
+        self.nodes[-1].outputs[index].default_value = value  # type: ignore
+
+    def _op_set_function_out(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, int), "Data should be an index"
-            socket = self.stack.pop()
+        socket = self.stack.pop()
+        if _VALIDATE:
             assert isinstance(socket, NodeSocket)
-            self.function_outputs[op_data] = socket
-        
-        elif op_type == OpType.SPLIT_STRUCT:
-            struct = self.stack.pop()
+        self.function_outputs[op_data] = socket
+
+    def _op_split_struct(self, op_data):
+        stack = self.stack
+        struct = stack.pop()
+        if _VALIDATE:
             assert isinstance(
                 struct, list
             ), "Bug in type checker, GET_OUTPUT only works on structs."
-            self.stack += struct
+        stack += [struct[index] for index in op_data]
 
-        elif op_type == OpType.CALL_FUNCTION:
+    def _op_call_function(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, CompiledFunction), "Bug in type checker."
-            args = self.get_args(self.stack, len(op_data.inputs))
-            # Store state outside function, and prepare state in function
-            outer_vars = self.variables
-            self.variables = {}
-            for name, arg in zip(op_data.inputs, args):
-                self.variables[name] = arg
-            outer_function_outputs = self.function_outputs
-            self.function_outputs = [None for _ in range(op_data.num_outputs)]
-            outer_stack = self.stack
-            self.stack = []
-            # Execute function
-            for operation in op_data.body:
-                self.operation(operation)
-            # Restore state outside function
-            self.stack = outer_stack
-            if len(self.function_outputs) == 1:
-                output = self.function_outputs[0]
+        args = self.get_args(self.stack, len(op_data.inputs))
+        # Store state outside function, and prepare state in function
+        outer_vars = self.variables
+        self.variables = dict(zip(op_data.inputs, args))
+        outer_function_outputs = self.function_outputs
+        self.function_outputs = [None] * op_data.num_outputs
+        outer_stack = self.stack
+        self.stack = []
+        # Execute function
+        self.execute(op_data.body)
+        # Restore state outside function
+        self.stack = outer_stack
+        function_outputs = self.function_outputs
+        num_outputs = op_data.num_outputs
+        if num_outputs == 1:
+            output = function_outputs[0]
+            if _VALIDATE:
                 assert isinstance(output, NodeSocket)
-                self.stack.append(output)
-            elif len(self.function_outputs) > 1:
-                for output in self.function_outputs:
+            outer_stack.append(output)
+        elif num_outputs > 1:
+            if _VALIDATE:
+                for output in function_outputs:
                     assert isinstance(output, NodeSocket)
-                self.stack.append(list(reversed(self.function_outputs)))  # type: ignore
-            self.function_outputs = outer_function_outputs
-            self.variables = outer_vars
+            outer_stack.append(function_outputs)
+        self.function_outputs = outer_function_outputs
+        self.variables = outer_vars
 
-        elif op_type == OpType.CALL_NODEGROUP:
-            assert isinstance(op_data, CompiledNodeGroup), "Bug in type checker."
-            args = self.get_args(self.stack, len(op_data.inputs))
-            self.execute_node_group(op_data, args)
-            
-        elif op_type == OpType.CALL_BUILTIN:
-            assert isinstance(op_data, NodeInstance), "Bug in compiler."
-            args = self.get_args(self.stack, len(op_data.inputs))
-            node = self.add_builtin(
-                op_data,
-                args,
-            )
-            outputs = op_data.outputs
-            if len(outputs) == 1:
-                self.stack.append(node.outputs[outputs[0]])
-            elif len(outputs) > 1:
-                self.stack.append([node.outputs[o] for o in reversed(outputs)])
-            self.nodes.append(node)
-
-        elif op_type == OpType.RENAME_NODE:
-            self.nodes[-1].label = op_data
-
-        elif op_type == OpType.CREATE_NODE_GROUP:
+    def _op_call_nodegroup(self, op_data):
+        if _VALIDATE:
             assert isinstance(op_data, CompiledNodeGroup), "Bug in type checker."
-            self.create_node_group(op_data)
-
-        elif op_type == OpType.CREATE_REPEAT_ZONE:
-
-            # Get iterations count from stack (compiled expression result)
-            iterations = self.stack.pop()
+        args = self.get_args(self.stack, len(op_data.inputs))
+        self.execute_node_group(op_data, args)
 
-            self.create_repeat_zone(iterations)
-
-        elif op_type == OpType.REPEAT_BODY:
-            assert isinstance(op_data, list), "Repeat body should be a list of operations."
-            self.execute_repeat_body(op_data)
+    def _op_call_builtin(self, op_data):
+        if _VALIDATE:
+            assert isinstance(op_data, NodeInstance), "Bug in compiler."
+        args = self.get_args(self.stack, len(op_data.inputs))
+        self.call_builtin(op_data, args)
+
+    def _op_call_builtin_with_args(self, op_data):
+        if _VALIDATE:
+            assert isinstance(op_data, tuple), "Data should be tuple of node and args"
+        node_info, arg_sources = op_data
+        if _VALIDATE:
+            assert isinstance(node_info, NodeInstance), "Bug in compiler."
+        variables = self.variables
+        args = [variables[value] if is_var else value for is_var, value in arg_sources]
+        self.call_builtin(node_info, args)
+
+    def call_builtin(self, node_info: NodeInstance, args: list[ValueType]):
+        node = self.add_builtin(
+            node_info,
+            args,
+        )
+        outputs = node_info.outputs
+        if len(outputs) == 1:
+            self.stack.append(node.outputs[outputs[0]])
+        elif len(outputs) > 1:
+            node_outputs = node.outputs
+            self.stack.append([node_outputs[o] for o in outputs])
+        self.nodes.append(node)
 
-        elif op_type == OpType.END_OF_STATEMENT:
-            self.stack = []
+    def _op_rename_node(self, op_data):
+        self.nodes[-1].label = op_data
 
-        else:
-            print(f"Need implementation of {op_type}")
-            raise NotImplementedError
+    def _op_create_node_group(self, op_data):
+        if _VALIDATE:
+            assert isinstance(op_data, CompiledNodeGroup), "Bug in type checker."
+        self.create_node_group(op_data)
+
+    def _op_create_repeat_zone(self, op_data):
+        # Get iterations count from stack (compiled expression result)
+        iterations = self.stack.pop()
+
+        self.create_repeat_zone(iterations)
+
+    def _op_repeat_body(self, op_data):
+        if _VALIDATE:
+            assert isinstance(op_data, CompiledRepeat), "Bug in compiler."
+        self.execute_repeat_body(op_data)
+
+    def _op_loop(self, op_data):
+        if _VALIDATE:
+            assert isinstance(op_data, CompiledLoop), "Bug in compiler."
+        # Calls inside the body always restore the same variables dict.
+        variables = self.variables
+        var = op_data.var
+        body = op_data.body
+        execute = self.execute
+        for i in range(op_data.start, op_data.end + 1):
+            if var is not None:
+                variables[var] = i
+            execute(body)
+
+    def _op_end_of_statement(self, op_data):
+        # Reuse the list, outer stacks are only ever held by the calls.
+        self.stack.clear()
 
     def get_args(self, stack: list, num_args: int) -> list[ValueType]:
         if num_args == 0:
             return []
         args = stack[-num_args:]
-        stack[:] = stack[:-num_args]
+        # Truncate in place instead of copying the rest of the stack.
+        del stack[-num_args:]
         return args
 
     def add_builtin(
@@ -176,67 +300,25 @@ class Interpreter:
         node = tree.nodes.new(type=node_info.key)
         for name, value in node_info.props:
             setattr(node, name, value)
-        for i, input_index in enumerate(node_info.inputs):
-            arg = args[i]
-            if isinstance(arg, bpy.types.NodeSocket):
-                tree.links.new(arg, node.inputs[input_index])
+        links_new = tree.links.new
+        inputs = node.inputs
+        for arg, input_index in zip(args, node_info.inputs):
+            if isinstance(arg, NodeSocket):
+                links_new(arg, inputs[input_index])
             elif arg is not None:
-                node.inputs[input_index].default_value = arg  # type: ignore
+                inputs[input_index].default_value = arg  # type: ignore
         return node
 
     @staticmethod
     def data_type_to_socket_type(dtype: DataType) -> str:
-        if dtype == DataType.BOOL:
-            return "NodeSocketBool"
-        elif dtype == DataType.INT:
-            return "NodeSocketInt"
-        elif dtype == DataType.FLOAT:
-            return "NodeSocketFloat"
-        elif dtype == DataType.RGBA:
-            return "NodeSocketColor"
-        elif dtype == DataType.VEC3:
-            return "NodeSocketVector"
-        elif dtype == DataType.GEOMETRY:
-            return "NodeSocketGeometry"
-        elif dtype == DataType.STRING:
-            return "NodeSocketString"
-        elif dtype == DataType.SHADER:
-            return "NodeSocketShader"
-        elif dtype == DataType.OBJECT:
-            return "NodeSocketObject"
-        elif dtype == DataType.IMAGE:
-            return "NodeSocketImage"
-        elif dtype == DataType.COLLECTION:
-            return "NodeSocketCollection"
-        elif dtype == DataType.TEXTURE:
-            return "NodeSocketTexture"
-        elif dtype == DataType.MATERIAL:
-            return "NodeSocketMaterial"
-        elif dtype == DataType.ROTATION:
-            return "NodeSocketRotation"
-        else:
-            assert False, "Unreachable"
+        socket_type = _DTYPE_SOCKETS[dtype]
+        assert socket_type is not None, "Unreachable"
+        return socket_type
 
     @staticmethod
     def socket_bl_idname_to_repeat_type(bl_idname: str) -> str:
         """Convert NodeSocket bl_idname to repeat zone socket_type enum"""
-        mapping = {
-            "NodeSocketBool": "BOOLEAN",
-            "NodeSocketInt": "INT", 
-            "NodeSocketFloat": "FLOAT",
-            "NodeSocketColor": "RGBA",
-            "NodeSocketVector": "VECTOR",
-            "NodeSocketGeometry": "GEOMETRY",
-            "NodeSocketString": "STRING",
-            "NodeSocketShader": "SHADER",
-            "NodeSocketObject": "OBJECT",
-            "NodeSocketImage": "IMAGE",
-            "NodeSocketCollection": "COLLECTION",
-            "NodeSocketTexture": "TEXTURE",
-            "NodeSocketMaterial": "MATERIAL",
-            "NodeSocketRotation": "ROTATION",
-        }
-        return mapping.get(bl_idname, "FLOAT")  # Default to FLOAT if unknown
+        return _SOCKET_TO_REPEAT_TYPE.get(bl_idname, "FLOAT")  # Default to FLOAT if unknown
 
     def execute_node_group(self, node_group: CompiledNodeGroup, args: list[ValueType]):
         if node_group.name in self.node_group_trees:
@@ -272,12 +354,11 @@ class Interpreter:
             for socket in group_input.outputs:
                 self.variables[socket.name] = socket
             outer_function_outputs = self.function_outputs
-            self.function_outputs = [None for _ in range(len(node_group.outputs))]
+            self.function_outputs = [None] * len(node_group.outputs)
             outer_stack = self.stack
             self.stack = []
             # Execute node group
-            for operation in node_group.body:
-                self.operation(operation)
+            self.execute(node_group.body)
 
             # Connect to the group outputs
             for index, foutput in enumerate(self.function_outputs):
@@ -295,27 +376,25 @@ class Interpreter:
             self.node_group_trees[node_group.name] = node_tree
 
         # Add the group and connect the arguments
-        group_name = (
-            "GeometryNodeGroup"
-            if self.tree.bl_idname == "GeometryNodeTree"
-            else "ShaderNodeGroup"
-        )
-        node = self.tree.nodes.new(group_name)
+        node = self.tree.nodes.new(self._group_node_type)
         node = cast(bpy.types.NodeGroup, node)
         node.node_tree = node_tree
+        links_new = self.tree.links.new
+        inputs = node.inputs
         for i, arg in enumerate(args):
             if isinstance(arg, NodeSocket):
-                self.tree.links.new(arg, node.inputs[i])
+                links_new(arg, inputs[i])
             elif arg is not None:
-                node.inputs[i].default_value = arg  # type: ignore
+                inputs[i].default_value = arg  # type: ignore
         self.nodes.append(node)
 
-        if len(node.outputs) == 1:
+        # The number of outputs is known from the compiled node group, there
+        # is no need to ask the node for it.
+        num_outputs = len(node_group.outputs)
+        if num_outputs == 1:
             self.stack.append(node.outputs[0])
-        elif len(node.outputs) > 1:
-            self.stack.append(
-                [node.outputs[i] for i in reversed(range(len(node.outputs)))]
-            )
+        elif num_outputs > 1:
+            self.stack.append(list(node.outputs))
 
     def create_repeat_zone(self, iterations):
 
@@ -354,7 +433,7 @@ class Interpreter:
         
         self.nodes.extend([input_node, output_node])
 
-    def execute_repeat_body(self, body_operations: list):
+    def execute_repeat_body(self, repeat: CompiledRepeat):
         """Execute repeat body and connect variables"""
         if not self.repeat_zone_stack:
             return
@@ -363,15 +442,13 @@ class Interpreter:
         input_node = repeat_zone['input_node']
         output_node = repeat_zone['output_node']
         
-        # Collect all variables recursively
-        loop_vars = set()
-        self._collect_vars_recursive(body_operations, loop_vars)
-        
         # Compare with external variables and capture only those that exist
+        variables = self.variables
         captured_vars = {}
-        for name in loop_vars:
-            if name in self.variables and isinstance(self.variables[name], NodeSocket):
-                captured_vars[name] = self.variables[name]
+        for name in repeat.loop_vars:
+            socket = variables.get(name)
+            if isinstance(socket, NodeSocket):
+                captured_vars[name] = socket
         
         
         # Create input/output slots for captured variables
@@ -403,8 +480,7 @@ class Interpreter:
             self.variables[name] = input_node.outputs[i + 1]
         
         # Execute body operations with proper variable connections
-        for operation in body_operations:
-            self.operation(operation)
+        self.execute(repeat.body)
         
         # Connect loop body results to output node inputs
         # This ensures data flows from the loop body to the output
@@ -418,11 +494,3 @@ class Interpreter:
         
         # Pop from stack instead of deleting attribute
         self.repeat_zone_stack.pop()
-
-    def _collect_vars_recursive(self, operations, loop_vars):
-        """Recursively collect all variables from operations, including nested repeat bodies"""
-        for op in operations:
-            if op.op_type == OpType.BIND_VAR:
-                loop_vars.add(op.data)
-            elif op.op_type == OpType.REPEAT_BODY and isinstance(op.data, list):
-                self._collect_vars_recursive(op.data, loop_vars)
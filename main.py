@@ -185,8 +185,7 @@ class MF_OT_math_formula_add(bpy.types.Operator, MFBase):
             return {"CANCELLED"}
         # Execute the compiled operations
         interpreter = Interpreter(tree)
-        for operation in compiler.operations:
-            interpreter.operation(operation)
+        interpreter.execute(compiler.operations)
         # The nodes that we added
         nodes: list[Node] = interpreter.nodes
         self.node_group_trees: list[bpy.types.NodeTree] = list(
@@ -266,8 +266,7 @@ if __name__ == "__main__":
                 compiler.compile(source)
 
                 interpreter = Interpreter(node_tree)
-                for operation in compiler.operations:
-                    interpreter.operation(operation)
+                interpreter.execute(compiler.operations)
 
                 # Do we have a previous output already?
                 output_path = os.path.join(
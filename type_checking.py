@@ -147,12 +147,13 @@ class TypeChecker:
                 target_indices.append(None)
                 out_targets.append(None)
                 continue
-            if target.id not in out_names:
+            try:
+                index = out_names.index(target.id)
+            except ValueError:
                 return self.error(
                     f'Function output target "{target.id}" doesn\'t match one of the functions output names.',
                     target,
                 )
-            index = out_names.index(target.id)
             self.used_function_outputs[index] = True
             target_indices.append(index)
             out_targets.append(self.function_outputs[index])
@@ -544,7 +545,9 @@ class TypeChecker:
             self.error("Expected some value to retrieve attribute from.", attr)
         assert isinstance(expr, td.ty_expr), "Checked above"
         # See if the name is one of the outputs
-        if attr.attr not in expr.out_names:
+        try:
+            index = expr.out_names.index(attr.attr)
+        except ValueError:
             return self.error(
                 f'"{attr.attr}" does not match one of the output names: {expr.out_names}',
                 attr,
@@ -559,7 +562,8 @@ class TypeChecker:
                 ), "Result of sep_xyz should be an expression"
             elif expr.dtype[0] == td.DataType.RGBA:
                 raise NotImplementedError
-        index = expr.out_names.index(attr.attr)
+        # The outputs of sep_xyz are named like the vector components, so the
+        # index found above is still valid.
         dtype = expr.dtype[index]
         out_names = []
         if dtype == td.DataType.VEC3: